@@ -7,25 +7,55 @@ This app allows users to:
 3. Ask questions about the indexed documents using RAG
 """
 
+import asyncio
+import multiprocessing
 import os
 import tempfile
-from typing import List, Optional, Tuple
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Iterator, List, Optional, Set, Tuple
 from pathlib import Path
 
 import gradio as gr
+import numpy as np
+import tiktoken
+import xxhash
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
 from langchain_community.vectorstores import Qdrant
 from langchain_community.document_loaders import (
-    PyPDFLoader,
+    PyPDFium2Loader,
     TextLoader,
 )
 from docx import Document as DocxDocument
 from pptx import Presentation
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams
+from qdrant_client.models import (
+    CollectionStatus,
+    Distance,
+    FieldCondition,
+    Filter,
+    HnswConfigDiff,
+    MatchAny,
+    OptimizersConfigDiff,
+    PayloadSchemaType,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    VectorParams,
+)
 
 # Try to load environment variables
 try:
@@ -35,73 +65,293 @@ except ImportError:
     pass
 
 # Global variables
-embeddings: Optional[OpenAIEmbeddings] = None
+embeddings: Optional[CacheBackedEmbeddings] = None
+qdrant_client: Optional[QdrantClient] = None
 vectorstore: Optional[Qdrant] = None
 llm: Optional[ChatOpenAI] = None
+qa_chain = None
 retriever = None
+loader_executor: Optional[ProcessPoolExecutor] = None
 collection_name = "gradio_rag_documents"
 
+# Local directory where Qdrant persists the collection
+QDRANT_PATH = os.getenv("QDRANT_PATH", "./qdrant_data")
+
+# Optional Qdrant server (e.g. "http://localhost:6333"), used instead of local storage when set
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+
+# Metadata field holding the hash used to skip chunks that are already indexed
+CHUNK_HASH_KEY = "chunk_hash"
+
+# Local directory where computed embeddings are cached (kept when the index is cleared)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./emb_cache")
+
+# Number of vectors in a segment above which Qdrant builds the HNSW index
+INDEXING_THRESHOLD = 20000
+
+# Number of worker processes used to load uploaded documents in parallel
+LOAD_DOCUMENTS_NUMBER_OF_THREADS = max(1, int(
+    os.getenv("LOAD_DOCUMENTS_NUMBER_OF_THREADS", (os.cpu_count() or 2) - 1)
+))
+
+# Maximum number of chunks per embedding batch. OpenAIEmbeddings also splits requests at
+# 300k tokens, so with 800-token chunks one HTTP call carries about 375 chunks at most.
+EMBEDDING_BATCH_SIZE = 1000
+
+# Maximum number of tokens of retrieved chunks sent to the LLM as context
+CONTEXT_TOKEN_BUDGET = 6000
+
+# Maximum number of embedding requests in flight at once (keeps us under rate limits)
+EMBEDDING_MAX_CONCURRENCY = 8
+
+def create_collection(client: QdrantClient):
+    """Create the documents collection with on-disk storage and int8 quantization
+    
+    The on-disk, quantization and optimizer settings only apply on a Qdrant server
+    (QDRANT_URL); local mode ignores them and keeps every vector in process RAM.
+    """
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config=VectorParams(
+            size=1536,  # text-embedding-3-small dimension
+            distance=Distance.COSINE,
+            on_disk=True  # Keep raw FP32 vectors in memory-mapped files
+        ),
+        # Score with int8 vectors kept in RAM (~4x smaller than FP32)
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        ),
+        optimizers_config=OptimizersConfigDiff(
+            memmap_threshold=20000,
+            indexing_threshold=INDEXING_THRESHOLD
+        ),
+        hnsw_config=HnswConfigDiff(on_disk=True)
+    )
+    
+    if QDRANT_URL:
+        # Index the chunk hashes so deduplication lookups stay fast on the server
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=f"{Qdrant.METADATA_KEY}.{CHUNK_HASH_KEY}",
+            field_schema=PayloadSchemaType.KEYWORD
+        )
+
+
+def chunk_hash(source: str, text: str) -> str:
+    """Compute a 64-bit hash of a chunk's source and text"""
+    # Include the source so a chunk shared by several files stays cited for each of them
+    data = f"{source}\0{text}".encode("utf-8")
+    return xxhash.xxh3_64_hexdigest(data)
+
+
+def find_indexed_hashes(hashes: List[str]) -> Set[str]:
+    """Return the chunk hashes already stored in the collection"""
+    # Ask Qdrant itself, so the answer holds even if another app instance changed the collection
+    key = f"{vectorstore.metadata_payload_key}.{CHUNK_HASH_KEY}"
+    found = set()
+    for i in range(0, len(hashes), EMBEDDING_BATCH_SIZE):
+        batch = hashes[i:i + EMBEDDING_BATCH_SIZE]
+        points, _ = qdrant_client.scroll(
+            collection_name=collection_name,
+            scroll_filter=Filter(must=[FieldCondition(key=key, match=MatchAny(any=batch))]),
+            limit=len(batch),
+            with_payload=True,
+            with_vectors=False
+        )
+        for point in points:
+            found.add(point.payload[vectorstore.metadata_payload_key][CHUNK_HASH_KEY])
+    return found
+
+
+# Enhanced prompt with better instructions for source citation (parsed once at import)
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a helpful assistant that answers questions based on the provided context from multiple documents.
+
+IMPORTANT INSTRUCTIONS:
+1. Synthesize information from ALL relevant documents provided in the context
+2. If information appears in multiple documents, mention all relevant sources
+3. Always cite the specific document name when referencing information
+4. If the answer cannot be found in the context, explicitly state this
+5. Be comprehensive and draw connections between information from different documents when relevant
+6. Format your answer clearly with proper structure"""),
+    ("human", """Context from indexed documents:
+
+{context}
+
+Question: {question}
+
+Provide a comprehensive answer based on the context above. Cite specific documents when referencing information.""")
+])
+
+
+def rescore(query_vector: np.ndarray, candidate_vectors: np.ndarray) -> np.ndarray:
+    """Compute the cosine similarity between a query and candidate vectors in one BLAS call"""
+    return np.dot(candidate_vectors, query_vector) / (
+        np.linalg.norm(candidate_vectors, axis=1) * np.linalg.norm(query_vector)
+    )
+
+
+class SourceGroupedRetriever(BaseRetriever):
+    """Retriever that groups hits by source document server-side in Qdrant"""
+    
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    
+    vectorstore: Qdrant
+    limit: int = 10  # Maximum number of source documents
+    group_size: int = 2  # Maximum number of chunks per source document
+    fetch_k: int = 20  # Number of candidates fetched when grouping client-side
+    
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vector = self.vectorstore.embeddings.embed_query(query)
+        
+        try:
+            # Scoring and grouping stay inside Qdrant, no candidate vectors are sent back
+            result = self.vectorstore.client.query_points_groups(
+                collection_name=self.vectorstore.collection_name,
+                query=query_vector,
+                group_by=f"{self.vectorstore.metadata_payload_key}.source",
+                limit=self.limit,
+                group_size=self.group_size,
+                with_payload=True
+            )
+        except Exception:
+            # Fallback to grouping client-side if groups are not supported
+            return self._group_client_side(query_vector)
+        
+        return [self._to_document(hit) for group in result.groups for hit in group.hits]
+    
+    def _group_client_side(self, query_vector: List[float]) -> List[Document]:
+        """Rescore candidates with NumPy and keep the best chunks of each source"""
+        points = self.vectorstore.client.query_points(
+            collection_name=self.vectorstore.collection_name,
+            query=query_vector,
+            limit=self.fetch_k,
+            with_payload=True,
+            with_vectors=True
+        ).points
+        if not points:
+            return []
+        
+        # Copy candidate vectors into a single FP32 matrix instead of lists of Python floats
+        candidates = np.empty((len(points), len(query_vector)), dtype=np.float32)
+        for i, point in enumerate(points):
+            candidates[i] = point.vector
+        scores = rescore(np.asarray(query_vector, dtype=np.float32), candidates)
+        
+        documents = []
+        chunks_per_source = {}
+        for i in np.argsort(-scores):
+            doc = self._to_document(points[i])
+            source = doc.metadata.get("source", "Unknown")
+            if source not in chunks_per_source and len(chunks_per_source) >= self.limit:
+                continue
+            if chunks_per_source.get(source, 0) >= self.group_size:
+                continue
+            chunks_per_source[source] = chunks_per_source.get(source, 0) + 1
+            documents.append(doc)
+        
+        return documents
+    
+    def _to_document(self, point) -> Document:
+        """Build a Document from a point, using the same payload layout as the vectorstore"""
+        payload = point.payload or {}
+        metadata = dict(payload.get(self.vectorstore.metadata_payload_key) or {})
+        metadata["_id"] = point.id
+        metadata["_collection_name"] = self.vectorstore.collection_name
+        return Document(
+            page_content=payload.get(self.vectorstore.content_payload_key, ""),
+            metadata=metadata
+        )
+
+
 # Initialize components
 def initialize_components():
     """Initialize embeddings, LLM, and Qdrant connection"""
-    global embeddings, llm, vectorstore, retriever
+    global embeddings, llm, qa_chain, qdrant_client, vectorstore, retriever
     
     # Check for API key
     if not os.getenv("OPENAI_API_KEY"):
         raise ValueError("OPENAI_API_KEY not found in environment variables!")
     
-    # Initialize embeddings and LLM
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+    # Initialize embeddings (cached on disk to skip re-embedding known chunks) and LLM
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        OpenAIEmbeddings(
+            model="text-embedding-3-small",
+            chunk_size=EMBEDDING_BATCH_SIZE,  # Max chunks per HTTP call (token limit may split further)
+            max_retries=6
+        ),
+        LocalFileStore(EMBEDDING_CACHE_PATH),
+        namespace="text-embedding-3-small",
+        key_encoder="sha256"
+    )
     llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    qa_chain = QA_PROMPT | llm | StrOutputParser()
     
-    # Initialize Qdrant client (using in-memory for demo, can be changed to persistent)
-    client = QdrantClient(location=":memory:")
+    # Initialize Qdrant client (server if configured, persistent local storage otherwise),
+    # shared for the app lifetime
+    if QDRANT_URL:
+        # gRPC (protobuf) avoids the HTTP + JSON encoding overhead
+        qdrant_client = QdrantClient(
+            url=QDRANT_URL,
+            api_key=os.getenv("QDRANT_API_KEY"),
+            prefer_grpc=True,
+            grpc_port=QDRANT_GRPC_PORT
+        )
+    else:
+        qdrant_client = QdrantClient(path=QDRANT_PATH)
     
     # Create collection if it doesn't exist
     try:
-        client.get_collection(collection_name)
+        qdrant_client.get_collection(collection_name)
     except Exception:
-        client.create_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(
-                size=1536,  # text-embedding-3-small dimension
-                distance=Distance.COSINE
-            )
-        )
+        create_collection(qdrant_client)
     
     # Create vectorstore
     vectorstore = Qdrant(
-        client=client,
+        client=qdrant_client,
         collection_name=collection_name,
         embeddings=embeddings
     )
     
-    # Create retriever with higher k to search across all documents
-    # Using MMR (Maximal Marginal Relevance) for better diversity across documents
-    try:
-        retriever = vectorstore.as_retriever(
-            search_type="mmr",  # Use MMR for diverse results
-            search_kwargs={"k": 10, "fetch_k": 20}  # Retrieve more chunks to ensure coverage
-        )
-    except Exception:
-        # Fallback to similarity search if MMR not supported
-        retriever = vectorstore.as_retriever(
-            search_kwargs={"k": 10}  # Still retrieve more chunks
-        )
+    # Create retriever grouping results by source for diversity across documents
+    retriever = SourceGroupedRetriever(vectorstore=vectorstore)
     
     return "✅ Components initialized successfully!"
 
 
-def load_document(file_path: str) -> List[Document]:
-    """Load a document based on its file extension"""
+def extract_slide_text(slide) -> List[str]:
+    """Extract the non-empty text of every shape on a slide"""
+    slide_text = []
+    for shape in slide.shapes:
+        if not hasattr(shape, "text"):
+            continue
+        # Each .text access rebuilds the text from the XML tree, so read it only once
+        text = shape.text
+        if text.strip():
+            slide_text.append(text)
+    return slide_text
+
+
+def load_document(file_path: str) -> Iterator[Document]:
+    """Lazily load a document based on its file extension"""
     file_ext = Path(file_path).suffix.lower()
     
     try:
         if file_ext == ".pdf":
-            loader = PyPDFLoader(file_path)
-            documents = loader.load()
+            # Stream pages one at a time instead of materializing the whole PDF
+            # PDFium (C++) extracts text much faster than pure-Python pypdf
+            loader = PyPDFium2Loader(file_path)
+            yield from loader.lazy_load()
         elif file_ext in [".doc", ".docx"]:
             # Load Word document using python-docx
+            # (kept as a single Document so chunks overlap across the whole text)
             doc = DocxDocument(file_path)
             text_content = []
             for paragraph in doc.paragraphs:
@@ -118,16 +368,13 @@ def load_document(file_path: str) -> List[Document]:
             if not full_text.strip():
                 raise ValueError("Document appears to be empty")
             
-            documents = [Document(page_content=full_text, metadata={"source": Path(file_path).name})]
+            yield Document(page_content=full_text, metadata={"source": Path(file_path).name})
         elif file_ext in [".ppt", ".pptx"]:
             # Load PowerPoint document using python-pptx
             prs = Presentation(file_path)
             text_content = []
             for slide_num, slide in enumerate(prs.slides, 1):
-                slide_text = []
-                for shape in slide.shapes:
-                    if hasattr(shape, "text") and shape.text.strip():
-                        slide_text.append(shape.text)
+                slide_text = extract_slide_text(slide)
                 if slide_text:
                     text_content.append(f"Slide {slide_num}:\n" + "\n".join(slide_text))
             
@@ -135,21 +382,125 @@ def load_document(file_path: str) -> List[Document]:
             if not full_text.strip():
                 raise ValueError("Presentation appears to be empty")
             
-            documents = [Document(page_content=full_text, metadata={"source": Path(file_path).name})]
+            yield Document(page_content=full_text, metadata={"source": Path(file_path).name})
         elif file_ext == ".txt":
             loader = TextLoader(file_path, encoding="utf-8")
-            documents = loader.load()
+            yield from loader.lazy_load()
         else:
             raise ValueError(f"Unsupported file type: {file_ext}")
-        
-        return documents
     except Exception as e:
         raise Exception(f"Error loading document {file_path}: {str(e)}")
 
 
-def index_documents(files: List[gr.File]) -> str:
+@lru_cache(maxsize=1)
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    """Build the token-based text splitter once per process"""
+    # Chunk length is measured in tokens with tiktoken (Rust BPE) instead of characters
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name="text-embedding-3-small",
+        chunk_size=800,
+        chunk_overlap=200,
+        separators=["\n\n", "\n", ". ", " ", ""]  # Better separators for natural breaks
+    )
+
+
+def load_and_split_document(file_path: str) -> List[Document]:
+    """Load a document, stamp its source metadata and split it into chunks (runs in a worker process)"""
+    text_splitter = get_text_splitter()
+    filename = Path(file_path).name
+    chunks = []
+    
+    # Split each page/batch as it is loaded so only one is in flight at a time
+    for doc in load_document(file_path):
+        # Add metadata here so only picklable Documents are sent back to the parent
+        doc.metadata["source"] = filename
+        doc.metadata["file_path"] = file_path
+        chunks.extend(text_splitter.split_documents([doc]))
+    
+    return chunks
+
+
+@lru_cache(maxsize=1)
+def get_llm_encoding() -> tiktoken.Encoding:
+    """Get the tokenizer of the LLM used to answer questions"""
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+
+def get_loader_executor() -> ProcessPoolExecutor:
+    """Get the document loader process pool, started once and reused across uploads"""
+    global loader_executor
+    if loader_executor is None:
+        # Fork is unsafe in the multi-threaded Gradio server, start workers from a forkserver
+        loader_executor = ProcessPoolExecutor(
+            max_workers=LOAD_DOCUMENTS_NUMBER_OF_THREADS,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    return loader_executor
+
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embed texts in batches, sending the batch requests to OpenAI concurrently"""
+    semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+    
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+    
+    batches = [
+        texts[i:i + EMBEDDING_BATCH_SIZE]
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vector for batch_vectors in results for vector in batch_vectors]
+
+
+def add_embedded_texts(texts: List[str], vectors: List[List[float]], metadatas: List[dict]):
+    """Upsert pre-computed embeddings using the same payload layout as the vectorstore"""
+    points = [
+        PointStruct(
+            id=uuid.uuid4().hex,
+            vector=vector,
+            payload={
+                vectorstore.content_payload_key: text,
+                vectorstore.metadata_payload_key: metadata
+            }
+        )
+        for text, vector, metadata in zip(texts, vectors, metadatas)
+    ]
+    client = vectorstore.client
+    
+    # Upload first and index once: disable HNSW indexing during the bulk upload
+    client.update_collection(
+        collection_name=collection_name,
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=0)
+    )
+    try:
+        for i in range(0, len(points), EMBEDDING_BATCH_SIZE):
+            client.upsert(
+                collection_name=collection_name,
+                points=points[i:i + EMBEDDING_BATCH_SIZE]
+            )
+    finally:
+        client.update_collection(
+            collection_name=collection_name,
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+        )
+    
+    wait_for_collection(client)
+
+
+def wait_for_collection(client: QdrantClient, timeout: float = 60.0):
+    """Wait until Qdrant has finished optimizing (indexing) the collection"""
+    deadline = time.monotonic() + timeout
+    while client.get_collection(collection_name).status != CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.5)
+
+
+async def index_documents(files: List[gr.File]) -> str:
     """Index uploaded documents to Qdrant"""
-    global vectorstore, embeddings
+    global vectorstore, embeddings, loader_executor
     
     if not files:
         return "⚠️ Please upload at least one document!"
@@ -157,71 +508,87 @@ def index_documents(files: List[gr.File]) -> str:
     if vectorstore is None:
         return "⚠️ Components not initialized! Please restart the app."
     
-    all_documents = []
+    chunks = []
     processed_files = []
     errors = []
     
-    # Process each uploaded file
-    for file in files:
-        if file is None:
-            continue
-            
-        file_path = file.name if hasattr(file, 'name') else file
-        
-        try:
-            # Load document
-            docs = load_document(file_path)
-            
-            # Add metadata
-            filename = Path(file_path).name
-            for doc in docs:
-                doc.metadata["source"] = filename
-                doc.metadata["file_path"] = file_path
-            
-            all_documents.extend(docs)
-            processed_files.append(filename)
-            
-        except Exception as e:
-            errors.append(f"{Path(file_path).name}: {str(e)}")
+    file_paths = [
+        file.name if hasattr(file, 'name') else file
+        for file in files
+        if file is not None
+    ]
+    
+    # Load and chunk uploaded files in parallel (parsing and splitting are CPU-bound)
+    if len(file_paths) == 1:
+        # A single file gains nothing from a pool, skip the process start-up cost
+        results = await asyncio.gather(
+            asyncio.to_thread(load_and_split_document, file_paths[0]),
+            return_exceptions=True
+        )
+    else:
+        loop = asyncio.get_running_loop()
+        executor = get_loader_executor()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, load_and_split_document, file_path)
+                for file_path in file_paths
+            ),
+            return_exceptions=True
+        )
+        if any(isinstance(result, BrokenProcessPool) for result in results):
+            # A worker died, start a fresh pool on the next upload
+            executor.shutdown(wait=False)
+            loader_executor = None
+    
+    for file_path, result in zip(file_paths, results):
+        if isinstance(result, Exception):
+            errors.append(f"{Path(file_path).name}: {str(result)}")
+        else:
+            chunks.extend(result)
+            processed_files.append(Path(file_path).name)
     
-    if not all_documents:
+    if not chunks:
         error_msg = "⚠️ No documents could be loaded!\n"
         if errors:
             error_msg += "\nErrors:\n" + "\n".join(f"- {e}" for e in errors)
         return error_msg
     
-    # Split documents into chunks with better overlap for context preservation
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-        separators=["\n\n", "\n", ". ", " ", ""]  # Better separators for natural breaks
-    )
-    chunks = text_splitter.split_documents(all_documents)
+    # Skip chunks repeated in this upload or already indexed for the same file (e.g. re-uploads)
+    chunk_count = len(chunks)
+    unique_chunks = {}
+    for chunk in chunks:
+        h = chunk_hash(chunk.metadata["source"], chunk.page_content)
+        if h not in unique_chunks:
+            chunk.metadata[CHUNK_HASH_KEY] = h
+            unique_chunks[h] = chunk
+    repeated_count = chunk_count - len(unique_chunks)
     
-    # Add chunk index to metadata for better tracking
-    for idx, chunk in enumerate(chunks):
-        if "chunk_index" not in chunk.metadata:
-            chunk.metadata["chunk_index"] = idx
+    try:
+        indexed_hashes = await asyncio.to_thread(find_indexed_hashes, list(unique_chunks))
+    except Exception as e:
+        return f"❌ Error checking indexed chunks: {str(e)}"
+    chunks = [chunk for h, chunk in unique_chunks.items() if h not in indexed_hashes]
+    already_indexed_count = len(indexed_hashes)
+    
+    if not chunks:
+        return f"ℹ️ All {chunk_count} chunks from {len(processed_files)} file(s) are already indexed!"
     
-    # Add to vectorstore
+    # Add to vectorstore, embedding chunks in large concurrent batches to minimize round trips
     try:
-        vectorstore.add_documents(chunks)
-        
-        # Update retriever with MMR for diverse retrieval
-        global retriever
-        try:
-            retriever = vectorstore.as_retriever(
-                search_type="mmr",
-                search_kwargs={"k": 10, "fetch_k": 20}
-            )
-        except Exception:
-            # Fallback to similarity search if MMR not supported
-            retriever = vectorstore.as_retriever(
-                search_kwargs={"k": 10}
-            )
+        texts = [chunk.page_content for chunk in chunks]
+        vectors = await embed_texts(texts)
+        await asyncio.to_thread(
+            add_embedded_texts,
+            texts,
+            vectors,
+            [chunk.metadata for chunk in chunks]
+        )
         
         success_msg = f"✅ Successfully indexed {len(chunks)} chunks from {len(processed_files)} file(s)!\n\n"
+        if already_indexed_count:
+            success_msg += f"Skipped {already_indexed_count} chunk(s) already indexed.\n\n"
+        if repeated_count:
+            success_msg += f"Skipped {repeated_count} duplicate chunk(s) repeated within this upload.\n\n"
         success_msg += f"Files processed:\n" + "\n".join(f"- {f}" for f in processed_files)
         
         if errors:
@@ -233,22 +600,26 @@ def index_documents(files: List[gr.File]) -> str:
         return f"❌ Error indexing documents: {str(e)}"
 
 
-def query_rag(question: str, history: List[Tuple[str, str]]) -> Tuple[str, List[Tuple[str, str]]]:
-    """Perform RAG query and return answer with detailed source attribution"""
-    global retriever, llm
+def query_rag(question: str, history: List[Tuple[str, str]]) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+    """Perform RAG query and stream the answer with detailed source attribution"""
+    global retriever, qa_chain
     
     if not question.strip():
-        return "", history
+        yield "", history
+        return
     
-    if retriever is None or llm is None:
-        return "⚠️ Please initialize components and index documents first!", history
+    if retriever is None or qa_chain is None:
+        yield "⚠️ Please initialize components and index documents first!", history
+        return
     
+    answer_started = False
     try:
-        # Retrieve relevant documents (MMR ensures diversity across all documents)
+        # Retrieve relevant documents (grouping by source ensures diversity across all documents)
         docs = retriever.invoke(question)
         
         if not docs:
-            return "⚠️ No relevant documents found. Please index some documents first.", history
+            yield "⚠️ No relevant documents found. Please index some documents first.", history
+            return
         
         # Group documents by source for better organization
         sources_dict = {}
@@ -258,55 +629,45 @@ def query_rag(question: str, history: List[Tuple[str, str]]) -> Tuple[str, List[
                 sources_dict[source] = []
             sources_dict[source].append(doc)
         
-        # Create context with clear source attribution
+        # Create context with clear source attribution, greedily packing chunks into the token budget
+        encoding = get_llm_encoding()
         context_parts = []
+        context_tokens = 0
+        used_sources_dict = {}
         for source, source_docs in sources_dict.items():
-            for idx, doc in enumerate(source_docs, 1):
-                chunk_preview = doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-                context_parts.append(
-                    f"[Document: {source} | Chunk {idx}]\n{doc.page_content}"
-                )
+            for doc in source_docs:
+                used_docs = used_sources_dict.get(source, [])
+                part = f"[Document: {source} | Chunk {len(used_docs) + 1}]\n{doc.page_content}"
+                part_tokens = len(encoding.encode(part))
+                if context_tokens + part_tokens > CONTEXT_TOKEN_BUDGET:
+                    continue
+                used_sources_dict.setdefault(source, []).append(doc)
+                context_parts.append(part)
+                context_tokens += part_tokens
         
         context = "\n\n---\n\n".join(context_parts)
         
-        # Enhanced prompt with better instructions for source citation
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful assistant that answers questions based on the provided context from multiple documents.
-
-IMPORTANT INSTRUCTIONS:
-1. Synthesize information from ALL relevant documents provided in the context
-2. If information appears in multiple documents, mention all relevant sources
-3. Always cite the specific document name when referencing information
-4. If the answer cannot be found in the context, explicitly state this
-5. Be comprehensive and draw connections between information from different documents when relevant
-6. Format your answer clearly with proper structure"""),
-            ("human", """Context from indexed documents:
-
-{context}
-
-Question: {question}
-
-Provide a comprehensive answer based on the context above. Cite specific documents when referencing information.""")
-        ])
-        
-        # Generate answer
-        chain = prompt | llm
-        response = chain.invoke({
-            "context": context[:6000],  # Increased context window
+        # Generate answer, streaming tokens to the chatbot as they arrive
+        history.append((question, ""))
+        answer_started = True
+        answer = ""
+        for chunk in qa_chain.stream({
+            "context": context,
             "question": question
-        })
-        
-        answer = response.content
+        }):
+            answer += chunk
+            history[-1] = (question, answer)
+            yield "", history
         
-        # Create detailed source information
-        unique_sources = list(sources_dict.keys())
+        # Create detailed source information from the chunks actually sent to the LLM
+        unique_sources = list(used_sources_dict.keys())
         source_count = len(unique_sources)
-        chunk_count = len(docs)
+        chunk_count = sum(len(source_docs) for source_docs in used_sources_dict.values())
         
         # Build source details with chunk previews (formatted for chatbot)
         sources_section = f"\n\n{'='*60}\n📚 **Sources Used** ({source_count} document(s), {chunk_count} chunk(s))\n{'='*60}\n\n"
         
-        for source, source_docs in sources_dict.items():
+        for source, source_docs in used_sources_dict.items():
             sources_section += f"📄 **{source}** ({len(source_docs)} chunk(s))\n"
             for idx, doc in enumerate(source_docs[:3], 1):  # Show first 3 chunks per document
                 preview = doc.page_content[:150].replace("\n", " ").strip()
@@ -320,51 +681,33 @@ Provide a comprehensive answer based on the context above. Cite specific documen
         answer_with_sources = f"{answer}{sources_section}"
         
         # Update history
-        history.append((question, answer_with_sources))
+        history[-1] = (question, answer_with_sources)
         
-        return "", history
+        yield "", history
         
     except Exception as e:
         error_msg = f"❌ Error processing query: {str(e)}"
-        history.append((question, error_msg))
-        return "", history
+        if answer_started:
+            history[-1] = (question, error_msg)
+        else:
+            history.append((question, error_msg))
+        yield "", history
 
 
 def clear_index() -> str:
     """Clear the vectorstore index"""
-    global vectorstore, retriever
+    # The vectorstore and retriever keep pointing at the recreated collection
+    if qdrant_client is None:
+        return "⚠️ Components not initialized! Please restart the app."
     
     try:
-        # Delete collection and recreate
-        client = QdrantClient(location=":memory:")
+        # Delete collection and recreate it on the same client
         try:
-            client.delete_collection(collection_name)
-        except:
+            qdrant_client.delete_collection(collection_name)
+        except Exception:
             pass
         
-        client.create_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(
-                size=1536,
-                distance=Distance.COSINE
-            )
-        )
-        
-        vectorstore = Qdrant(
-            client=client,
-            collection_name=collection_name,
-            embeddings=embeddings
-        )
-        
-        try:
-            retriever = vectorstore.as_retriever(
-                search_type="mmr",
-                search_kwargs={"k": 10, "fetch_k": 20}
-            )
-        except Exception:
-            retriever = vectorstore.as_retriever(
-                search_kwargs={"k": 10}
-            )
+        create_collection(qdrant_client)
         
         return "✅ Index cleared successfully!"
     except Exception as e:
@@ -496,7 +839,7 @@ def create_interface():
                 **💡 Tips:**
                 - Questions are answered using information from **all indexed documents**
                 - Answers include source citations with chunk previews
-                - Use MMR (Maximal Marginal Relevance) for diverse, comprehensive results
+                - Results are grouped by source document for diverse, comprehensive results
                 """)
         
         # Footer with info
@@ -504,7 +847,7 @@ def create_interface():
         ---
         **🔍 RAG Features:**
         - **Multi-document search**: Queries search across all indexed documents
-        - **MMR retrieval**: Ensures diverse results from different documents
+        - **Grouped retrieval**: Ensures diverse results from different documents
         - **Source attribution**: Every answer includes detailed source citations
         - **Chunk previews**: See which document sections were used
         """)